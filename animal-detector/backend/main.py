@@ -1,15 +1,19 @@
 import fastapi
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 import io
-import base64
 import os # Added for environment variables
 import datetime # Added for handling dates
+import functools
+import uuid
+import warnings
 from typing import List
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter, ValidationError
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 # SQLAlchemy imports
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session # Added for dependency injection
@@ -34,7 +38,23 @@ if not DATABASE_URL:
     print("WARNING: DATABASE_URL environment variable is not set. Database features will not work.")
     # raise ValueError("DATABASE_URL environment variable is not set.") # Commented out for local testing flexibility
 
-engine = create_engine(DATABASE_URL)
+_IS_SQLITE = (DATABASE_URL or "").startswith("sqlite")
+
+if _IS_SQLITE:
+    # Sessions are used from threadpool workers, so SQLite connections must be shareable across threads
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # Runs once per pooled connection rather than on every request
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+else:
+    # Keep warm connections around between requests; no ping round trip on checkout
+    engine = create_engine(DATABASE_URL, pool_size=10, max_overflow=20, pool_pre_ping=False, pool_recycle=1800)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -61,7 +81,9 @@ def create_db_tables():
 
 @app.on_event("startup")
 async def startup_event():
-    create_db_tables()
+    # Schema creation is opt-in (set RUN_MIGRATIONS, e.g. for local SQLite) so cold starts skip the DDL round trips
+    if os.getenv("RUN_MIGRATIONS"):
+        create_db_tables()
 
 
 class Box(BaseModel):
@@ -73,106 +95,172 @@ class Box(BaseModel):
     date: str
 
 class Annotation(BaseModel):
-    image: str  # base64 encoded image
     boxes: List[Box]
     latitude: float | None = None
     longitude: float | None = None
 
+_BOXES = TypeAdapter(List[Box]) # Boxes arrive as a JSON form field next to the uploaded file
+
+
+# --- Image decoding limits ---
+# Larger inputs are rejected instead of exhausting the worker's memory. Pillow only raises
+# DecompressionBombError above twice the limit and just warns in between, so the warning is made an error too
+Image.MAX_IMAGE_PIXELS = 50_000_000
+warnings.simplefilter("error", Image.DecompressionBombWarning)
+# Big JPEGs are decoded at a reduced scale, never below this size
+_JPEG_DRAFT_SIZE = (2048, 2048)
+
+# --- Text drawing helpers ---
+_FONT = ImageFont.load_default() # Loaded once instead of on every request
+
+# Every label uses the same font, so the line height is a constant
+if hasattr(_FONT, "getmetrics"):
+    _ascent, _descent = _FONT.getmetrics()
+    _LINE_HEIGHT = _ascent + _descent
+else: # Bitmap fallback font when Pillow is built without FreeType
+    _LINE_HEIGHT = _FONT.getbbox("Ag")[3]
+
+_LABEL_PAD = 6 # Background margin around the text, which is drawn 2px in from the corner
+
+def _render_line(text: str, fg: tuple) -> Image.Image:
+    # One label line on a transparent background; getlength() is cheaper than a full bounding box
+    tile = Image.new("RGBA", (int(_FONT.getlength(text)), _LINE_HEIGHT), fg + (0,))
+    ImageDraw.Draw(tile).text((0, 0), text, fill=fg, font=_FONT)
+    return tile
+
+# Names and dates repeat across requests, so their lines are pasted from a cache instead of re-running
+# FreeType. The coordinates line changes with every request and goes through _render_line directly
+_tile = functools.lru_cache(maxsize=512)(_render_line)
+
+def _draw_label(image: Image.Image, draw: ImageDraw.ImageDraw, tiles: list[Image.Image], x: float, y: float, bg: tuple):
+    width = max(tile.width for tile in tiles)
+    height = _LINE_HEIGHT * len(tiles)
+    left, top = round(x), round(y)
+    # Labels that fall entirely outside the image are skipped before anything is drawn
+    if left >= image.width or top >= image.height or left + width + _LABEL_PAD <= 0 or top + height + _LABEL_PAD <= 0:
+        return
+    # One blended background for the whole block, then each line on top, masked by its own alpha
+    draw.rectangle([left, top, left + width + _LABEL_PAD - 1, top + height + _LABEL_PAD - 1], fill=bg)
+    for i, tile in enumerate(tiles):
+        image.paste(tile, (left + 2, top + 2 + i * _LINE_HEIGHT), tile)
+
+def _encode_png(image: Image.Image) -> bytes:
+    # Plain RGB with optimize off keeps the encoder in its zlib loop, which runs without the GIL,
+    # so renders running side by side in the threadpool encode on separate cores
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG", compress_level=1, optimize=False) # Fast zlib level, size matters less than CPU here
+    return buffered.getvalue()
 
-@app.post("/annotate_image_for_download/")
-async def annotate_image_for_download(annotation: Annotation, db: Session = Depends(get_db)):
-    # Decode base64 image
-    header, encoded_image = annotation.image.split(",", 1)
-    image_data = base64.b64decode(encoded_image)
-    image_bytes_io = io.BytesIO(image_data)
-    original_image = Image.open(image_bytes_io).convert("RGB") # Ensure RGB for drawing
 
-    draw = ImageDraw.Draw(original_image)
-    
-    font = ImageFont.load_default()
+def _render(image_data: bytes, annotation: Annotation) -> bytes:
+    # Decode, draw and re-encode the image. Runs in a worker thread so the
+    # event loop stays free while Pillow/zlib do the heavy lifting.
+    image_bytes_io = io.BytesIO(image_data)
+    try:
+        original_image = Image.open(image_bytes_io)
+        source_size = original_image.size
+        if original_image.format == "JPEG": # Let libjpeg decode straight to RGB, downscaled by DCT when huge
+            original_image.draft("RGB", _JPEG_DRAFT_SIZE)
+        original_image.load()
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        raise fastapi.HTTPException(status_code=413, detail="Image is too large to process.")
+    except OSError: # UnidentifiedImageError for non-images, plain OSError for truncated or corrupt files
+        raise fastapi.HTTPException(status_code=415, detail="Uploaded file is not a supported image.")
+    if original_image.mode != "RGB": # Ensure RGB for drawing, without copying images that already are
+        original_image = original_image.convert("RGB")
 
     # Define colors
     box_color = (255, 0, 0) # Red
     text_color = (255, 255, 255) # White
     bg_color = (0, 0, 0, 128) # Semi-transparent black for text background
 
-    # Generate a unique ID for this image (to link annotations in DB)
-    image_id_gen = f"img_{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}"
-
-
-    # Draw boxes and their associated info
-    for i, box in enumerate(annotation.boxes):
-        # Draw the bounding box
-        draw.rectangle([box.x1, box.y1, box.x2, box.y2], outline=box_color, width=2)
-
-        # --- Draw Name (top-left, outside the box) ---
-        name_text = box.name
-        name_text_bbox_coords = draw.textbbox((0,0), name_text, font=font) # Use (0,0) for size calculation
-        name_text_width = name_text_bbox_coords[2] - name_text_bbox_coords[0]
-        name_text_height = name_text_bbox_coords[3] - name_text_bbox_coords[1]
-
-        name_x = box.x1
-        name_y = box.y1 - name_text_height - 5 # 5 pixels padding above
-        if name_y < 0: # If text goes above image, put it inside the box
-            name_y = box.y1 + 5
-
-        # Draw background and text for name
-        draw.rectangle([name_x, name_y, name_x + name_text_width + 5, name_y + name_text_height + 5], fill=bg_color) # Add padding to background
-        draw.text((name_x + 2, name_y + 2), name_text, fill=text_color, font=font) # Add padding to text
-
-
-        # --- Draw Date (top-right, outside the box, aligned with name_y) ---
-        date_text_y_offset = 0 # Offset if name is inside the box
-        if name_y == box.y1 + 5: # If name was placed inside, date should be slightly below name.
-            date_text_y_offset = name_text_height + 5 # Place below name if name is inside
-
+    # Each box gets one label block: name, then date and coordinates when present
+    coords_tile = None
+    if annotation.latitude is not None and annotation.longitude is not None:
+        coords_tile = _render_line(f"Lat: {annotation.latitude:.4f}, Lon: {annotation.longitude:.4f}", text_color)
+    label_tiles = []
+    for box in annotation.boxes:
+        tiles = [_tile(box.name, text_color)]
         if box.date:
-            date_text = f"Fecha: {box.date}"
-            date_text_bbox_coords = draw.textbbox((0,0), date_text, font=font)
-            date_text_width = date_text_bbox_coords[2] - date_text_bbox_coords[0]
-            date_text_height = date_text_bbox_coords[3] - date_text_bbox_coords[1]
-
-            date_x = box.x2 - date_text_width - 5 # 5 pixels padding from right
-            date_y = name_y + date_text_y_offset # Align with name_y, or offset
-
-            # Draw background and text for date
-            draw.rectangle([date_x, date_y, date_x + date_text_width + 5, date_y + date_text_height + 5], fill=bg_color)
-            draw.text((date_x + 2, date_y + 2), date_text, fill=text_color, font=font)
-
-
-        # --- Draw Latitude and Longitude (inside the box, top-right) ---
-        if annotation.latitude is not None and annotation.longitude is not None:
-            coords_text = f"Lat: {annotation.latitude:.4f}, Lon: {annotation.longitude:.4f}"
-            coords_text_bbox_coords = draw.textbbox((0,0), coords_text, font=font)
-            coords_text_width = coords_text_bbox_coords[2] - coords_text_bbox_coords[0]
-            coords_text_height = coords_text_bbox_coords[3] - coords_text_bbox_coords[1]
-
-            coords_x = box.x2 - coords_text_width - 5 # 5 pixels padding from right, inside box
-            coords_y = box.y1 + 5 # 5 pixels padding from top, inside box
-
-            # Draw background and text for coordinates
-            draw.rectangle([coords_x, coords_y, coords_x + coords_text_width + 5, coords_y + coords_text_height + 5], fill=bg_color)
-            draw.text((coords_x + 2, coords_y + 2), coords_text, fill=text_color, font=font)
-
-        # --- Save annotation data to the database ---
-        db_entry = AnnotationEntry(
-            image_id=image_id_gen,
-            box_name=box.name,
-            box_date=box.date,
-            annotation_latitude=annotation.latitude,
-            annotation_longitude=annotation.longitude
-        )
-        db.add(db_entry)
-    
+            tiles.append(_tile(f"Fecha: {box.date}", text_color))
+        if coords_tile is not None:
+            tiles.append(coords_tile)
+        label_tiles.append(tiles)
+
+    # Lay out every label at once: one (N, 4) array of box corners, one row per box
+    xy = np.array([[box.x1, box.y1, box.x2, box.y2] for box in annotation.boxes], dtype=np.float32).reshape(-1, 4)
+    if original_image.size != source_size: # Boxes are in source pixels, the draft decode may be smaller
+        scale_x = original_image.width / source_size[0]
+        scale_y = original_image.height / source_size[1]
+        xy *= np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+    label_heights = np.array([len(tiles) for tiles in label_tiles], dtype=np.float32) * _LINE_HEIGHT
+    x1, y1 = xy[:, 0], xy[:, 1]
+
+    # Outlines are drawn straight onto the photo; Pillow's C rectangle only touches the edge pixels.
+    # RGBA drawing mode blends fills with an alpha, which the label backgrounds rely on
+    draw = ImageDraw.Draw(original_image, "RGBA")
+    corners = np.concatenate([np.minimum(xy[:, :2], xy[:, 2:]), np.maximum(xy[:, :2], xy[:, 2:])], axis=1) # Boxes dragged up/left
+    for box_xy in corners.tolist():
+        draw.rectangle(box_xy, outline=box_color, width=2)
+
+    # Labels sit above the top-left corner (5 pixels padding), or inside the box if that goes above the image
+    label_y = y1 - label_heights - 5
+    label_y = np.where(label_y < 0, y1 + 5, label_y)
+
+    # Draw the background and text block for each box
+    for tiles, x, y in zip(label_tiles, x1.tolist(), label_y.tolist()):
+        _draw_label(original_image, draw, tiles, x, y, bg_color)
+
+    return _encode_png(original_image)
+
+def _save_entries(db: Session, annotation: Annotation, image_id: str):
+    # --- Save annotation data to the database ---
+    # One bulk INSERT for all boxes instead of an ORM object per box
+    rows = [
+        {
+            "image_id": image_id,
+            "box_name": box.name,
+            "box_date": box.date,
+            "annotation_latitude": annotation.latitude,
+            "annotation_longitude": annotation.longitude,
+        }
+        for box in annotation.boxes
+    ]
+    if not rows:
+        return
+
+    db.execute(AnnotationEntry.__table__.insert(), rows)
     db.commit() # Commit all entries for this image
-    # db.refresh(db_entry) # No need to refresh here, as we are returning the image.
 
-    # Encode the annotated image back to base64
-    buffered = io.BytesIO()
-    original_image.save(buffered, format="PNG") # Save as PNG
-    encoded_annotated_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
+@app.post("/annotate_image_for_download/")
+async def annotate_image_for_download(
+    file: fastapi.UploadFile,
+    boxes_json: str = fastapi.Form(...),
+    latitude: float | None = fastapi.Form(None),
+    longitude: float | None = fastapi.Form(None),
+    db: Session = fastapi.Depends(get_db),
+):
+    # The image comes in as a raw multipart upload and goes back as raw PNG bytes,
+    # so neither leg pays for base64 (33% larger on the wire plus a decode/encode pass)
+    try:
+        boxes = _BOXES.validate_json(boxes_json)
+    except ValidationError as e:
+        # Point the locations at the form field, the way FastAPI reports its own body errors
+        errors = [{**error, "loc": ("body", "boxes_json", *error["loc"])} for error in e.errors()]
+        raise fastapi.exceptions.RequestValidationError(errors)
+    annotation = Annotation(boxes=boxes, latitude=latitude, longitude=longitude)
+    image_data = await file.read()
+
+    # Generate a unique ID for this image (to link annotations in DB)
+    image_id_gen = f"img_{uuid.uuid4().hex}" # Timestamps can collide between concurrent requests
+
+    # Both steps block (Pillow and the DB driver), so keep them off the event loop
+    annotated_image = await run_in_threadpool(_render, image_data, annotation)
+    await run_in_threadpool(_save_entries, db, annotation, image_id_gen)
 
-    return {"annotated_image": f"data:image/png;base64,{encoded_annotated_image}", "message": "Annotation saved to DB and image processed."}
+    return fastapi.Response(content=annotated_image, media_type="image/png")
 
 @app.get("/")
 def read_root():